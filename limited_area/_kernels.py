@@ -0,0 +1,336 @@
+from __future__ import absolute_import, division, print_function
+import math
+
+import numpy as np
+
+try:
+    from numba import njit, prange
+    _HAVE_NUMBA = True
+except ImportError:
+    # Without Numba, run the kernels as plain Python
+    _HAVE_NUMBA = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+""" _kernels.py - Numba compiled kernels for the traversals of the global
+MPAS mesh that are done while creating a regional mesh. These operate
+directly upon the raw connectivity arrays rather than upon a MeshHandler.
+
+The traversals use preallocated int32 stacks with an integer top index
+rather than Python lists, which also keeps them reasonably fast when they
+are run without Numba. """
+
+
+@njit(inline='always')
+def _fill_cell(j, bdyMaskCell, stack, top, INSIDE, UNMARKED):
+    """ Mark cell j as INSIDE and push it if it is UNMARKED, returning the
+    new top of stack """
+    if bdyMaskCell[j] == UNMARKED:
+        bdyMaskCell[j] = INSIDE
+        stack[top] = j
+        top += 1
+    return top
+
+
+@njit(cache=True)
+def _flood_fill(nEdgesOnCell, cellsOnCell, bdyMaskCell, inCell, INSIDE, UNMARKED):
+    """ Mark every UNMARKED cell that can be reached from inCell as INSIDE,
+    updating bdyMaskCell in place.
+
+    nEdgesOnCell -- Number of neighbors of each cell
+    cellsOnCell  -- The (0-based) neighbors of each cell
+    bdyMaskCell  -- The global mask marking the regional cell subset
+    inCell       -- A cell that is inside the regional area
+    INSIDE       -- The value used to mark interior cells
+    UNMARKED     -- The value used to mark cells that are not yet marked
+    """
+    # Each cell is pushed at most once (when it is marked), so a stack of
+    # nCells entries can never overflow
+    stack = np.empty(bdyMaskCell.shape[0], np.int32)
+    stack[0] = inCell
+    top = 1
+    while top > 0:
+        top -= 1
+        iCell = int(stack[top])
+        # Nearly all cells of an MPAS mesh are hexagons, so give them an
+        # unrolled path
+        if nEdgesOnCell[iCell] == 6:
+            top = _fill_cell(cellsOnCell[iCell, 0], bdyMaskCell, stack, top, INSIDE, UNMARKED)
+            top = _fill_cell(cellsOnCell[iCell, 1], bdyMaskCell, stack, top, INSIDE, UNMARKED)
+            top = _fill_cell(cellsOnCell[iCell, 2], bdyMaskCell, stack, top, INSIDE, UNMARKED)
+            top = _fill_cell(cellsOnCell[iCell, 3], bdyMaskCell, stack, top, INSIDE, UNMARKED)
+            top = _fill_cell(cellsOnCell[iCell, 4], bdyMaskCell, stack, top, INSIDE, UNMARKED)
+            top = _fill_cell(cellsOnCell[iCell, 5], bdyMaskCell, stack, top, INSIDE, UNMARKED)
+        else:
+            for i in range(nEdgesOnCell[iCell]):
+                top = _fill_cell(cellsOnCell[iCell, i], bdyMaskCell, stack, top, INSIDE, UNMARKED)
+
+
+@njit(cache=True)
+def _sphere_distance(lat1, lon1, lat2, lon2, radius):
+    """ Scalar version of mesh.sphere_distance """
+    return (2 * radius * math.asin(
+                         math.sqrt(
+                         math.sin(0.5 * (lat2 - lat1))**2
+                       + math.cos(lat1)
+                       * math.cos(lat2)
+                       * math.sin(0.5 * (lon2 - lon1))**2)))
+
+
+@njit(cache=True)
+def _walk_segment(sourceCell, targetCell, pta, nEdgesOnCell, cellsOnCell,
+                  latCells, lonCells, cellXYZ, bdyMaskCell, INSIDE):
+    """ Mark the cells along the great-arc from sourceCell to targetCell as
+    INSIDE, updating bdyMaskCell in place.
+
+    Starting at sourceCell, step to the neighbor that is no farther from
+    targetCell and lies closest to the plane of the great-arc, until
+    targetCell is reached.
+
+    sourceCell   -- The cell the segment starts at
+    targetCell   -- The cell the segment ends at
+    pta          -- Unit normal of the plane of the great-arc
+    nEdgesOnCell -- Number of neighbors of each cell
+    cellsOnCell  -- The (0-based) neighbors of each cell
+    latCells     -- Latitude of each cell - Radians
+    lonCells     -- Longitude of each cell - Radians
+    cellXYZ      -- Unit vector of each cell center
+    bdyMaskCell  -- The global mask marking the regional cell subset
+    INSIDE       -- The value used to mark interior cells
+    """
+    px = pta[0]
+    py = pta[1]
+    pz = pta[2]
+
+    # The target does not move within a segment
+    tgtLat = latCells[targetCell]
+    tgtLon = lonCells[targetCell]
+
+    iCell = sourceCell
+    while iCell != targetCell:
+        bdyMaskCell[iCell] = INSIDE
+        minangle = math.inf
+        mindist = _sphere_distance(latCells[iCell], lonCells[iCell],
+                                   tgtLat, tgtLon, 1.0)
+        k = -1
+        for j in range(nEdgesOnCell[iCell]):
+            v = cellsOnCell[iCell, j]
+            dist = _sphere_distance(latCells[v], lonCells[v],
+                                    tgtLat, tgtLon, 1.0)
+            if dist > mindist:
+                continue
+            # pi/2 - acos(x) == asin(x)
+            angle = abs(math.asin(px * cellXYZ[v, 0]
+                                + py * cellXYZ[v, 1]
+                                + pz * cellXYZ[v, 2]))
+            if angle < minangle:
+                minangle = angle
+                k = v
+
+        # No neighbor brings us closer to the target, so stop rather than
+        # walking in place
+        if k < 0:
+            break
+        iCell = k
+
+
+@njit(cache=True)
+def _walk_all_segments(boundaryCells, planes, nEdgesOnCell, cellsOnCell,
+                       latCells, lonCells, cellXYZ, bdyMaskCell, INSIDE):
+    """ Mark boundaryCells, and the cells along the great-arcs between each
+    of them and the next, as INSIDE, updating bdyMaskCell in place.
+
+    boundaryCells -- The cells nearest to the points of the boundary
+    planes        -- Unit normal of the plane of the great-arc from each of
+                     boundaryCells to the next
+    nEdgesOnCell  -- Number of neighbors of each cell
+    cellsOnCell   -- The (0-based) neighbors of each cell
+    latCells      -- Latitude of each cell - Radians
+    lonCells      -- Longitude of each cell - Radians
+    cellXYZ       -- Unit vector of each cell center
+    bdyMaskCell   -- The global mask marking the regional cell subset
+    INSIDE        -- The value used to mark interior cells
+    """
+    nBoundaryCells = boundaryCells.shape[0]
+    for i in range(nBoundaryCells):
+        bdyMaskCell[boundaryCells[i]] = INSIDE
+
+    for i in range(nBoundaryCells):
+        sourceCell = boundaryCells[i]
+        targetCell = boundaryCells[(i + 1) % nBoundaryCells]
+
+        # If we are already at the next target cell, there is no need
+        # to connect sourceCell with targetCell, and we can skip to
+        # the next pair of boundary points
+        if sourceCell == targetCell:
+            continue
+
+        _walk_segment(sourceCell, targetCell, planes[i], nEdgesOnCell,
+                      cellsOnCell, latCells, lonCells, cellXYZ, bdyMaskCell,
+                      INSIDE)
+
+
+@njit(parallel=True, cache=True)
+def _mark_edges(bdyMaskCell, cellsOnEdge):
+    """ Return bdyMaskEdge, where each edge takes the smallest positive value
+    of its two cells, or the largest value if neither is positive.
+
+    bdyMaskCell -- The global mask marking the regional cell subset
+    cellsOnEdge -- The (0-based) cells on each edge
+    """
+    bdyMaskEdge = np.empty(cellsOnEdge.shape[0], bdyMaskCell.dtype)
+    for iEdge in prange(cellsOnEdge.shape[0]):
+        a = bdyMaskCell[cellsOnEdge[iEdge, 0]]
+        b = bdyMaskCell[cellsOnEdge[iEdge, 1]]
+        # Order the two values with a single comparison
+        if a > b:
+            a, b = b, a
+        bdyMaskEdge[iEdge] = a if a > 0 else b
+
+    return bdyMaskEdge
+
+
+@njit(parallel=True, cache=True)
+def _mark_vertices(bdyMaskCell, cellsOnVertex):
+    """ Return bdyMaskVertex, where each vertex takes the smallest positive
+    value of its cells, or the largest value if none are positive.
+
+    bdyMaskCell   -- The global mask marking the regional cell subset
+    cellsOnVertex -- The (0-based) cells on each vertex
+    """
+    bdyMaskVertex = np.empty(cellsOnVertex.shape[0], bdyMaskCell.dtype)
+    for iVertex in prange(cellsOnVertex.shape[0]):
+        maskMin = bdyMaskCell[cellsOnVertex[iVertex, 0]]
+        maskMax = maskMin
+        for i in range(1, cellsOnVertex.shape[1]):
+            m = bdyMaskCell[cellsOnVertex[iVertex, i]]
+            maskMin = min(maskMin, m)
+            maskMax = max(maskMax, m)
+        bdyMaskVertex[iVertex] = maskMin if maskMin > 0 else maskMax
+
+    return bdyMaskVertex
+
+
+if not _HAVE_NUMBA:
+    # As plain Python, the loops of _mark_edges and _mark_vertices are much
+    # slower than gathering the cell masks and reducing them with NumPy
+
+    def _mark_edges(bdyMaskCell, cellsOnEdge):
+        """ NumPy version of _mark_edges """
+        masks = bdyMaskCell[cellsOnEdge]
+        maskMin = masks.min(axis=1)
+        return np.where(maskMin > 0, maskMin, masks.max(axis=1))
+
+    def _mark_vertices(bdyMaskCell, cellsOnVertex):
+        """ NumPy version of _mark_vertices """
+        masks = bdyMaskCell[cellsOnVertex]
+        maskMin = masks.min(axis=1)
+        return np.where(maskMin > 0, maskMin, masks.max(axis=1))
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def _expand_layer(frontier, cellsOnCell, nEdgesOnCell, bdyMaskCell, layer):
+    """ Mark the unmarked neighbors of the cells in frontier as layer,
+    updating bdyMaskCell in place.
+
+    Cells of the frontier may share unmarked neighbors, so more than one
+    thread may mark the same cell. They all write the same value, so the
+    result does not depend on the order of the writes.
+
+    frontier     -- The cells whose neighbors are marked
+    cellsOnCell  -- The (0-based) neighbors of each cell
+    nEdgesOnCell -- Number of neighbors of each cell
+    bdyMaskCell  -- The global mask marking the regional cell subset
+    layer        -- The relaxation layer
+    """
+    for n in prange(frontier.shape[0]):
+        iCell = int(frontier[n])
+        for i in range(nEdgesOnCell[iCell]):
+            j = cellsOnCell[iCell, i]
+            if bdyMaskCell[j] == 0:
+                bdyMaskCell[j] = layer
+
+
+@njit(inline='always')
+def _extend_frontier(j, bdyMaskCell, seen, frontier, size, layer, INSIDE):
+    """ Append cell j to the frontier if it is an unseen cell of the region,
+    returning the new size of the frontier """
+    if seen[j] == 0 and layer > bdyMaskCell[j] >= INSIDE:
+        seen[j] = 1
+        frontier[size] = j
+        size += 1
+    return size
+
+
+@njit(parallel=True, cache=True)
+def _build_masks(nEdgesOnCell, cellsOnCell, cellsOnEdge, cellsOnVertex,
+                 bdyMaskCell, inCell, num_layers, INSIDE, UNMARKED):
+    """ Flood fill the region containing inCell, mark its relaxation layers
+    and return bdyMaskCell, bdyMaskEdge and bdyMaskVertex.
+
+    This produces the same masks as flood_fill, followed by mark_neighbors
+    for each layer, mark_edges and mark_vertices, but does so in a single
+    call. Each relaxation layer is found by only
+    expanding the frontier of the previous layer in parallel, rather than
+    searching the whole region again.
+
+    nEdgesOnCell  -- Number of neighbors of each cell
+    cellsOnCell   -- The (0-based) neighbors of each cell
+    cellsOnEdge   -- The (0-based) cells on each edge
+    cellsOnVertex -- The (0-based) cells on each vertex
+    bdyMaskCell   -- The global mask with the boundary of the region marked,
+                     which is updated in place
+    inCell        -- A cell that is inside the regional area
+    num_layers    -- The number of relaxation layers
+    INSIDE        -- The value used to mark interior cells
+    UNMARKED      -- The value used to mark cells that are not yet marked
+    """
+    nCells = bdyMaskCell.shape[0]
+
+    _flood_fill(nEdgesOnCell, cellsOnCell, bdyMaskCell, inCell, INSIDE, UNMARKED)
+
+    # The cells of the region whose neighbors may still need to be marked.
+    # A cell is added to the frontier at most once, when it is first seen.
+    frontier = np.empty(nCells, np.int32)
+    seen = np.zeros(nCells, np.uint8)
+    frontier[0] = inCell
+    seen[inCell] = 1
+    size = 1
+
+    # After the flood fill every neighbor of inCell is marked, so the layer
+    # equal to INSIDE would not mark any cells
+    for layer in range(INSIDE + 1, num_layers + 1):
+        # Extend the frontier with any cells of the region that are reachable
+        # from it and that have not been seen
+        head = 0
+        while head < size:
+            iCell = int(frontier[head])
+            head += 1
+            # As in _flood_fill, give the hexagons an unrolled path
+            if nEdgesOnCell[iCell] == 6:
+                size = _extend_frontier(cellsOnCell[iCell, 0], bdyMaskCell, seen, frontier, size, layer, INSIDE)
+                size = _extend_frontier(cellsOnCell[iCell, 1], bdyMaskCell, seen, frontier, size, layer, INSIDE)
+                size = _extend_frontier(cellsOnCell[iCell, 2], bdyMaskCell, seen, frontier, size, layer, INSIDE)
+                size = _extend_frontier(cellsOnCell[iCell, 3], bdyMaskCell, seen, frontier, size, layer, INSIDE)
+                size = _extend_frontier(cellsOnCell[iCell, 4], bdyMaskCell, seen, frontier, size, layer, INSIDE)
+                size = _extend_frontier(cellsOnCell[iCell, 5], bdyMaskCell, seen, frontier, size, layer, INSIDE)
+            else:
+                for i in range(nEdgesOnCell[iCell]):
+                    size = _extend_frontier(cellsOnCell[iCell, i], bdyMaskCell, seen, frontier, size, layer, INSIDE)
+
+        _expand_layer(frontier[:size], cellsOnCell, nEdgesOnCell, bdyMaskCell, layer)
+
+        # The cells that were just marked are the frontier of the next layer
+        newCells = np.nonzero(bdyMaskCell == layer)[0]
+        size = newCells.shape[0]
+        frontier[:size] = newCells
+        seen[newCells] = 1
+
+    bdyMaskEdge = _mark_edges(bdyMaskCell, cellsOnEdge)
+    bdyMaskVertex = _mark_vertices(bdyMaskCell, cellsOnVertex)
+
+    return bdyMaskCell, bdyMaskEdge, bdyMaskVertex
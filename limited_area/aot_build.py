@@ -0,0 +1,67 @@
+from __future__ import absolute_import, division, print_function
+import os
+import types
+
+from numba import njit
+from numba.pycc import CC
+
+from limited_area._kernels import _build_masks
+from limited_area._kernels import _expand_layer
+from limited_area._kernels import _mark_edges
+from limited_area._kernels import _mark_vertices
+from limited_area._kernels import _walk_all_segments
+
+""" aot_build.py - Compile ahead of time versions of the Numba kernels that
+create_region runs into the _la_kernels extension module, so that they do
+not need to be JIT compiled the first time create_region is run. From the
+base directory run:
+
+    $ python -m limited_area.aot_build
+
+pycc cannot compile parallel kernels, so _build_masks is compiled as a
+serial kernel. The compiled kernels only accept the types that MeshHandler
+and LimitedArea create: int32 nEdgesOnCell and 0-based connectivity arrays,
+float64 coordinates and an int8 bdyMaskCell. """
+
+cc = CC('_la_kernels')
+cc.output_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def _serial(kernel, **kernels):
+    """ Return a serial copy of the Numba kernel kernel, in which prange acts
+    as range, and which calls the given kernels in place of those of the
+    same names that kernel calls """
+    func = kernel.py_func
+    funcGlobals = dict(func.__globals__, **kernels)
+    return njit(types.FunctionType(func.__code__, funcGlobals, func.__name__,
+                                   func.__defaults__, func.__closure__))
+
+
+_build_masks_serial = _serial(_build_masks,
+                              _expand_layer=_serial(_expand_layer),
+                              _mark_edges=_serial(_mark_edges),
+                              _mark_vertices=_serial(_mark_vertices))
+
+
+@cc.export('build_masks',
+           'Tuple((int8[::1], int8[::1], int8[::1]))'
+           '(int32[::1], int32[:, ::1], int32[:, ::1], int32[:, ::1], int8[::1],'
+           ' int64, int64, int64, int64)')
+def build_masks(nEdgesOnCell, cellsOnCell, cellsOnEdge, cellsOnVertex,
+                bdyMaskCell, inCell, num_layers, INSIDE, UNMARKED):
+    return _build_masks_serial(nEdgesOnCell, cellsOnCell, cellsOnEdge,
+                               cellsOnVertex, bdyMaskCell, inCell, num_layers,
+                               INSIDE, UNMARKED)
+
+
+@cc.export('walk_all_segments',
+           'void(intp[::1], float64[:, ::1], int32[::1], int32[:, ::1],'
+           ' float64[::1], float64[::1], float64[:, ::1], int8[::1], int64)')
+def walk_all_segments(boundaryCells, planes, nEdgesOnCell, cellsOnCell,
+                      latCells, lonCells, cellXYZ, bdyMaskCell, INSIDE):
+    _walk_all_segments(boundaryCells, planes, nEdgesOnCell, cellsOnCell,
+                       latCells, lonCells, cellXYZ, bdyMaskCell, INSIDE)
+
+
+if __name__ == "__main__":
+    cc.compile()
@@ -5,9 +5,19 @@ import sys
 
 import numpy as np
 
+from limited_area._kernels import _flood_fill
+from limited_area._kernels import _mark_edges
+from limited_area._kernels import _mark_vertices
+
+try:
+    # Use the ahead of time compiled kernels if they have been built, see
+    # aot_build.py
+    from limited_area._la_kernels import build_masks as _build_masks
+    from limited_area._la_kernels import walk_all_segments as _walk_all_segments
+except ImportError:
+    from limited_area._kernels import _build_masks
+    from limited_area._kernels import _walk_all_segments
 from limited_area.mesh import MeshHandler
-from limited_area.mesh import latlon_to_xyz
-from limited_area.mesh import sphere_distance
 from limited_area.region_spec import RegionSpec
 
 class LimitedArea():
@@ -52,20 +62,20 @@ class LimitedArea():
             print("ERROR: Mesh file was not found", mesh_file)
             sys.exit(-1)
 
+        # Tree of the cell centers, built by mark_boundary when it is needed
+        self._cell_tree = None
+
         # Check to see the points file exists and if it exists, then parse it
         # and see that is is specified correctly!
         self.region_file = region
         self.regionSpec = RegionSpec(*args, **kwargs)
 
-        # Choose the algorithm to mark relaxation region
+        # Choose the algorithm to mark relaxation region. The default,
+        # 'search', marks them within _build_masks in gen_region
         if self.boundary == None:
-            # Possibly faster for larger regions
             self.mark_neighbors = self._mark_neighbors
-        elif self.boundary == 'search':
-            # Possibly faster for smaller regions
-            self.mark_neighbors = self._mark_neighbors_search
-        
-        
+
+
     def gen_region(self, *args, **kwargs):
         """ Generate the boundary region of the given region for the given mesh(es). """
 
@@ -87,7 +97,7 @@ class LimitedArea():
         # so, create a unmarked, filled bdyMaskCell and pass it to
         # mark_boundary for each boundary.
         print('Marking ', end=''); sys.stdout.flush()
-        bdyMaskCell = np.full(self.mesh.nCells, self.UNMARKED)
+        bdyMaskCell = np.full(self.mesh.nCells, self.UNMARKED, dtype=np.int8)
         i = 1
         for boundary in boundaries:
             print("boundary ", i, "... ", end=''); sys.stdout.flush(); i += 1
@@ -96,45 +106,54 @@ class LimitedArea():
         # Find the nearest cell to the inside point
         inCell = self.mesh.nearest_cell(inPoint[0], inPoint[1])
 
-        # Flood fill from the inside point
-        print('\nFilling region ...')
-        bdyMaskCell = self.flood_fill(self.mesh, inCell, bdyMaskCell)
-
-        # Mark the neighbors
-        print('Creating boundary layer:', end=' '); sys.stdout.flush()
-        for layer in range(1, self.num_boundary_layers + 1):
-            print(layer, ' ...', end=' '); sys.stdout.flush()
-            self.mark_neighbors(self.mesh, layer, bdyMaskCell, inCell=inCell)
-        print('DONE!')
+        if self.boundary == 'search':
+            # Flood fill from the inside point, mark the relaxation layers and
+            # then the edges and vertices of the region within one kernel
+            print('\nFilling region, creating boundary layers and marking'
+                  ' edges and vertices ...')
+            bdyMaskCell, bdyMaskEdge, bdyMaskVertex = _build_masks(
+                                    np.asarray(self.mesh.nEdgesOnCell),
+                                    self.mesh.cellsOnCell0,
+                                    self.mesh.cellsOnEdge0,
+                                    self.mesh.cellsOnVertex0,
+                                    bdyMaskCell,
+                                    inCell,
+                                    self.num_boundary_layers,
+                                    self.INSIDE,
+                                    self.UNMARKED)
+
+            if self._DEBUG_ > 2:
+                self._print_mask_counts('bdyMaskCells', bdyMaskCell)
+                self._print_mask_counts('bdyMaskEdges', bdyMaskEdge)
+                self._print_mask_counts('bdyMaskVertex', bdyMaskVertex)
+        else:
+            # Flood fill from the inside point
+            print('\nFilling region ...')
+            bdyMaskCell = self.flood_fill(self.mesh, inCell, bdyMaskCell)
+
+            # Mark the neighbors
+            print('Creating boundary layer:', end=' '); sys.stdout.flush()
+            for layer in range(1, self.num_boundary_layers + 1):
+                print(layer, ' ...', end=' '); sys.stdout.flush()
+                self.mark_neighbors(self.mesh, layer, bdyMaskCell, inCell=inCell)
+            print('DONE!')
+
+            if self._DEBUG_ > 2:
+                self._print_mask_counts('bdyMaskCells', bdyMaskCell)
+
+            # Mark the edges
+            print('Marking region edges ...')
+            bdyMaskEdge = self.mark_edges(self.mesh,
+                                          bdyMaskCell,
+                                          *args,
+                                          **kwargs)
 
-        if self._DEBUG_ > 2:
-            print("DEBUG: bdyMaskCells count:")
-            print("DEBUG: 0: ", len(bdyMaskCell[bdyMaskCell == 0]))
-            print("DEBUG: 1: ", len(bdyMaskCell[bdyMaskCell == 1]))
-            print("DEBUG: 2: ", len(bdyMaskCell[bdyMaskCell == 2]))
-            print("DEBUG: 3: ", len(bdyMaskCell[bdyMaskCell == 3]))
-            print("DEBUG: 4: ", len(bdyMaskCell[bdyMaskCell == 4]))
-            print("DEBUG: 5: ", len(bdyMaskCell[bdyMaskCell == 5]))
-            print("DEBUG: 6: ", len(bdyMaskCell[bdyMaskCell == 6]))
-            print("DEBUG: 7: ", len(bdyMaskCell[bdyMaskCell == 7]))
-            print("DEBUG: 8: ", len(bdyMaskCell[bdyMaskCell == 8]))
-            print('\n')
-
-        bdyMaskCell_cp = bdyMaskCell
-
-        # Mark the edges
-        print('Marking region edges ...')
-        bdyMaskEdge = self.mark_edges(self.mesh,
-                                      bdyMaskCell,
-                                      *args,
-                                      **kwargs)
-
-        # Mark the vertices
-        print('Marking region vertices...')
-        bdyMaskVertex = self.mark_vertices(self.mesh,
-                                           bdyMaskCell,
-                                           *args,
-                                           **kwargs)
+            # Mark the vertices
+            print('Marking region vertices...')
+            bdyMaskVertex = self.mark_vertices(self.mesh,
+                                               bdyMaskCell,
+                                               *args,
+                                               **kwargs)
 
 
         # Subset the grid into a new region:
@@ -164,6 +183,15 @@ class LimitedArea():
 
         return regionFname, graphFname
 
+    def _print_mask_counts(self, name, mask):
+        """ Print the number of cells, edges or vertices of mask that are
+        marked with each of the values 0 through 8 """
+        counts = np.bincount(np.clip(mask, 0, 8), minlength=9)
+        print("DEBUG: " + name + " count:")
+        for k in range(9):
+            print("DEBUG: " + str(k) + ": ", counts[k])
+        print('\n')
+
     def create_partiton_fname(self, name, mesh, **kwargs):
         """ Generate the filename for the regional graph.info file"""
         return name+'.graph.info'
@@ -191,35 +219,6 @@ class LimitedArea():
         return name+'.'+meshType+'.nc'
 
 
-    # Mark_neighbors_search - Faster for smaller regions ??
-    def _mark_neighbors_search(self, mesh, layer, bdyMaskCell, *args, **kwargs):
-        """ Mark the relaxation layers using a search and return an updated bdyMaskCell with
-        those relaxation layers
-        
-        mesh        -- The global MPAS mesh
-        layer       -- The relaxation layer
-        bdyMaskCell -- The global mask marking the regional cell subset
-        inCell      -- A point that is inside the regional area
-
-        """
-        inCell = kwargs.get('inCell', None)
-        if inCell == None:
-            print("ERROR: In cell not found within _mark_neighbors_search")
-
-        stack = [inCell]
-        while len(stack) > 0:
-            iCell = stack.pop()
-            for i in range(mesh.nEdgesOnCell[iCell]):
-                j = mesh.cellsOnCell[iCell, i] - 1
-                if layer > bdyMaskCell[j] >= self.INSIDE:
-                    bdyMaskCell[j] = -bdyMaskCell[j]
-                    stack.append(j)
-                elif bdyMaskCell[j] == 0:
-                    bdyMaskCell[j] = layer 
-
-        bdyMaskCell[:] = abs(bdyMaskCell[:])
-
-
     # mark_neighbors - Faster for larger regions ??
     def _mark_neighbors(self, mesh, nType, bdyMaskCell, *args, **kwargs):
         """ Mark a relaxation layers of nType
@@ -229,12 +228,17 @@ class LimitedArea():
         bdyMaskCell -- The global mask marking the regional cell subset
         """
 
-        for iCell in range(mesh.nCells):
-            if bdyMaskCell[iCell] == self.UNMARKED:
-                for i in range(mesh.nEdgesOnCell[iCell]):
-                    v = mesh.cellsOnCell[iCell, i] - 1
-                    if bdyMaskCell[v] == 0:
-                        bdyMaskCell[v] == nType
+        # Mask of the neighbors of every cell, with the unused neighbor slots
+        # of cells that have less than maxEdges neighbors left unmarked
+        valid = np.arange(mesh.maxEdges) < np.asarray(mesh.nEdgesOnCell)[:, None]
+        cellsOnCell = np.where(valid, mesh.cellsOnCell0, 0)
+        neighbors = np.where(valid, bdyMaskCell[cellsOnCell], self.UNMARKED)
+
+        # Mark the unmarked cells that neighbor a cell of the region or one of
+        # its previous relaxation layers
+        inRegion = (neighbors >= self.INSIDE) & (neighbors < nType)
+        unmarked = bdyMaskCell == self.UNMARKED
+        bdyMaskCell[unmarked & inRegion.any(axis=1)] = nType
 
 
     def flood_fill(self, mesh, inCell, bdyMaskCell):
@@ -249,14 +253,12 @@ class LimitedArea():
         if self._DEBUG_ > 1:
             print("DEBUG: Flood filling with flood_fill")
 
-        stack = [inCell]
-        while len(stack) > 0:
-            iCell = stack.pop()
-            for i in range(mesh.nEdgesOnCell[iCell]):
-                j = mesh.cellsOnCell[iCell, i] - 1
-                if bdyMaskCell[j] == self.UNMARKED:
-                    bdyMaskCell[j] = self.INSIDE
-                    stack.append(j)
+        _flood_fill(np.asarray(mesh.nEdgesOnCell),
+                    mesh.cellsOnCell0,
+                    bdyMaskCell,
+                    inCell,
+                    self.INSIDE,
+                    self.UNMARKED)
 
         return bdyMaskCell
 
@@ -265,23 +267,10 @@ class LimitedArea():
         """ Mark the edges that are in the specified region and return
         bdyMaskEdge. """
 
-        bdyMaskEdge = bdyMaskCell[mesh.cellsOnEdge[:,:]-1].min(axis=1)
-        bdyMaskEdge = np.where(bdyMaskEdge > 0,
-                               bdyMaskEdge,
-                               bdyMaskCell[mesh.cellsOnEdge[:,:]-1].max(axis=1))
+        bdyMaskEdge = _mark_edges(bdyMaskCell, mesh.cellsOnEdge0)
 
         if self._DEBUG_ > 2:
-            print("DEBUG: bdyMaskEdges count:")
-            print("DEBUG: 0: ", len(bdyMaskEdge[bdyMaskEdge == 0]))
-            print("DEBUG: 1: ", len(bdyMaskEdge[bdyMaskEdge == 1]))
-            print("DEBUG: 2: ", len(bdyMaskEdge[bdyMaskEdge == 2]))
-            print("DEBUG: 3: ", len(bdyMaskEdge[bdyMaskEdge == 3]))
-            print("DEBUG: 4: ", len(bdyMaskEdge[bdyMaskEdge == 4]))
-            print("DEBUG: 5: ", len(bdyMaskEdge[bdyMaskEdge == 5]))
-            print("DEBUG: 6: ", len(bdyMaskEdge[bdyMaskEdge == 6]))
-            print("DEBUG: 7: ", len(bdyMaskEdge[bdyMaskEdge == 7]))
-            print("DEBUG: 8: ", len(bdyMaskEdge[bdyMaskEdge == 8]))
-            print('\n')
+            self._print_mask_counts('bdyMaskEdges', bdyMaskEdge)
 
         return bdyMaskEdge
 
@@ -290,27 +279,40 @@ class LimitedArea():
         """ Mark the vertices that are in the spefied region and return
         bdyMaskVertex."""
 
-        bdyMaskVertex = bdyMaskCell[mesh.cellsOnVertex[:,:]-1].min(axis=1)
-        bdyMaskVertex = np.where(bdyMaskVertex > 0,
-                                 bdyMaskVertex,
-                                 bdyMaskCell[mesh.cellsOnVertex[:,:]-1].max(axis=1))
+        bdyMaskVertex = _mark_vertices(bdyMaskCell, mesh.cellsOnVertex0)
 
         if self._DEBUG_ > 2:
-            print("DEBUG: bdyMaskVertex count:")
-            print("DEBUG: 0: ", len(bdyMaskVertex[bdyMaskVertex == 0]))
-            print("DEBUG: 1: ", len(bdyMaskVertex[bdyMaskVertex == 1]))
-            print("DEBUG: 2: ", len(bdyMaskVertex[bdyMaskVertex == 2]))
-            print("DEBUG: 3: ", len(bdyMaskVertex[bdyMaskVertex == 3]))
-            print("DEBUG: 4: ", len(bdyMaskVertex[bdyMaskVertex == 4]))
-            print("DEBUG: 5: ", len(bdyMaskVertex[bdyMaskVertex == 5]))
-            print("DEBUG: 6: ", len(bdyMaskVertex[bdyMaskVertex == 6]))
-            print("DEBUG: 7: ", len(bdyMaskVertex[bdyMaskVertex == 7]))
-            print("DEBUG: 8: ", len(bdyMaskVertex[bdyMaskVertex == 8]))
-            print('\n')
+            self._print_mask_counts('bdyMaskVertex', bdyMaskVertex)
 
         return bdyMaskVertex
     
 
+    def _nearest_cell_tree(self, mesh, nPoints):
+        """ Return a BallTree of the cell centers of mesh to find the nearest
+        cells to nPoints points with, or None if the points should be found
+        with mesh.nearest_cells.
+
+        Building the tree costs O(nCells) while finding a single point with
+        nearest_cell only costs O(sqrt(nCells)), so the tree is only built
+        when there are more than sqrt(nCells) points and scikit-learn is
+        available. """
+        if self._cell_tree is None:
+            if nPoints**2 <= mesh.nCells:
+                return None
+
+            try:
+                from sklearn.neighbors import BallTree
+            except ImportError:
+                return None
+
+            self._cell_tree = BallTree(np.column_stack([mesh.latCells,
+                                                        mesh.lonCells]),
+                                       metric='haversine',
+                                       leaf_size=40)
+
+        return self._cell_tree
+
+
     # Mark Boundary points
     def mark_boundary(self, mesh, points, bdyMaskCell, *args, **kwargs):
         """ Mark the nearest cell to each of the cords in points
@@ -326,76 +328,47 @@ class LimitedArea():
         if self._DEBUG_ > 0:
             print("DEBUG: Marking the boundary points: ")
 
-        boundaryCells = []
-
         # Find the nearest cells to the list of given boundary points
-        for i in range(0, len(points), 2):
-            boundaryCells.append(mesh.nearest_cell(points[i],
-                                                   points[i + 1]))
-
+        pts = np.asarray(points).reshape(-1, 2)
+        tree = self._nearest_cell_tree(mesh, len(pts))
+        if tree is not None:
+            _, idx = tree.query(pts, k=1)
+            boundaryCells = idx[:, 0].tolist()
+        else:
+            boundaryCells = mesh.nearest_cells(pts[:, 0], pts[:, 1]).tolist()
 
 
         if self._DEBUG_ > 0:
             print("DEBUG: Num Boundary Cells: ", len(boundaryCells))
 
-        # Mark the boundary cells that were given as input
-        for bCells in boundaryCells:
-            bdyMaskCell[bCells] = self.INSIDE
-
-        # For each boundaryCells, mark the current cell as the source cell
-        # and the next (or the first element if the current is the last) as 
-        # the target cell.
+        # Unit normals of the planes of the great-arcs between each of the
+        # boundaryCells and the next. The normal is undefined where both
+        # cells are the same, but those segments are skipped.
+        srcXYZ = mesh.cellXYZ[boundaryCells]
+        tgtXYZ = np.roll(srcXYZ, -1, axis=0)
+        planes = np.cross(srcXYZ, tgtXYZ)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            planes /= np.linalg.norm(planes, axis=1)[:, np.newaxis]
+
+        # Mark the boundary cells that were given as input. Then, for each
+        # boundaryCells, mark the current cell as the source cell and the
+        # next (or the first element if the current is the last) as the
+        # target cell.
         #
         # Then, determine the great-arc angle between the source and taget
         # cell, and then for each cell, starting at the source cell, 
         # calculate the great-arc angle between the cells on the current
         # cell and the target cell, and then add the cell with the smallest
         # angle.
-        for i in range(len(boundaryCells)):
-            sourceCell = boundaryCells[i]
-            targetCell = boundaryCells[(i + 1) % len(boundaryCells)]
-
-            # If we are already at the next target cell, there is no need
-            # to connect sourceCell with targetCell, and we can skip to
-            # the next pair of boundary points
-            if sourceCell == targetCell:
-                continue
-
-            pta = latlon_to_xyz(mesh.latCells[sourceCell],
-                                mesh.lonCells[sourceCell],
-                                1.0)
-            ptb = latlon_to_xyz(mesh.latCells[targetCell],
-                                mesh.lonCells[targetCell],
-                                1.0)
-        
-            pta = np.cross(pta, ptb)
-            temp = np.linalg.norm(pta)
-            pta = pta / temp
-            iCell = sourceCell
-            while iCell != targetCell:
-                bdyMaskCell[iCell] = self.INSIDE
-                minangle = np.Infinity
-                mindist = sphere_distance(mesh.latCells[iCell],
-                                          mesh.lonCells[iCell],
-                                          mesh.latCells[targetCell],
-                                          mesh.lonCells[targetCell],
-                                          1.0)
-                for j in range(mesh.nEdgesOnCell[iCell]):
-                    v = mesh.cellsOnCell[iCell, j] - 1
-                    dist = sphere_distance(mesh.latCells[v],
-                                           mesh.lonCells[v],
-                                           mesh.latCells[targetCell],
-                                           mesh.lonCells[targetCell],
-                                           1.0)
-                    if dist > mindist:
-                        continue
-                    pt = latlon_to_xyz(mesh.latCells[v], mesh.lonCells[v], 1.0)
-                    angle = np.dot(pta, pt)
-                    angle = abs(0.5 * np.pi - np.arccos(angle))
-                    if angle < minangle:
-                        minangle = angle
-                        k = v
-                iCell = k
+        _walk_all_segments(np.asarray(boundaryCells, dtype=np.intp),
+                           planes,
+                           np.asarray(mesh.nEdgesOnCell),
+                           mesh.cellsOnCell0,
+                           np.asarray(mesh.latCells),
+                           np.asarray(mesh.lonCells),
+                           mesh.cellXYZ,
+                           bdyMaskCell,
+                           self.INSIDE)
 
         return bdyMaskCell
 
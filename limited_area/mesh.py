@@ -93,10 +93,20 @@ class MeshHandler:
         self.cellsOnEdge = self.mesh.variables['cellsOnEdge'][:]
         self.cellsOnVertex = self.mesh.variables['cellsOnVertex'][:]
 
+        # 0-based copies of the connectivity arrays for indexing. MPAS meshes
+        # have far fewer than 2**31 cells, so int32 indices are sufficient
+        self.cellsOnCell0 = np.asarray(self.cellsOnCell - 1, dtype=np.int32)
+        self.cellsOnEdge0 = np.asarray(self.cellsOnEdge - 1, dtype=np.int32)
+        self.cellsOnVertex0 = np.asarray(self.cellsOnVertex - 1, dtype=np.int32)
+
         self.indexToCellIDs = self.mesh.variables['indexToCellID'][:]
         self.indexToEdgeIDs = self.mesh.variables['indexToEdgeID'][:]
         self.indexToVertexIDs = self.mesh.variables['indexToVertexID'][:]
 
+        # Unit vectors of the cell centers as a contiguous (nCells, 3) array
+        self.cellXYZ = latlon_to_xyz_vec(np.asarray(self.latCells),
+                                         np.asarray(self.lonCells)).astype(np.float64)
+
         # Attributes
         self.sphere_radius = self.mesh.sphere_radius
 
@@ -133,7 +143,7 @@ class MeshHandler:
             nearest_distance = current_distance
             
             for edges in range(self.nEdgesOnCell[current_cell]):
-                iCell = self.cellsOnCell[current_cell, edges] - 1
+                iCell = self.cellsOnCell0[current_cell, edges]
                 if (iCell <= self.nCells):
                     iDistance = sphere_distance(self.latCells[iCell],
                                                 self.lonCells[iCell],
@@ -155,6 +165,37 @@ class MeshHandler:
 
         return nearest_cell
 
+    def nearest_cells(self, lats, lons):
+        """ Find the nearest cells of this mesh to each of the points given
+        by lats and lons and return their indices as an array
+
+        Upon the unit sphere, the nearest cell to a point is the cell whose
+        center has the largest dot product with that point, so all points are
+        found with a matrix product against cellXYZ.
+
+        That product costs O(nCells) for each point, while nearest_cell only
+        walks O(sqrt(nCells)) cells, though much more slowly per cell. So on
+        large meshes each point is found with nearest_cell instead.
+
+        lats - Latitudes - Radians
+        lons - Longitudes - Radians
+        """
+        if self.nCells > 2**20:
+            return np.array([self.nearest_cell(lat, lon)
+                             for lat, lon in zip(lats, lons)], dtype=np.intp)
+
+        ptsXYZ = latlon_to_xyz_vec(np.asarray(lats), np.asarray(lons))
+
+        # Limit the size of the (nCells, nPoints) matrix of dot products
+        chunk = 2**24 // self.nCells
+
+        nearest = np.empty(len(ptsXYZ), dtype=np.intp)
+        for i in range(0, len(ptsXYZ), chunk):
+            sims = np.dot(self.cellXYZ, ptsXYZ[i:i+chunk].T)
+            nearest[i:i+chunk] = np.argmax(sims, axis=0)
+
+        return nearest
+
     def create_graph_file(self, graphFname):
         """ Create a graph.info file for the current mesh """
 
@@ -215,6 +256,13 @@ class MeshHandler:
         # Don't pass on DEBUG to the regional mess - tone down output
         kwargs.pop('DEBUG')
 
+        # The masks only hold values up to the number of relaxation layers
+        # and may be of a small integer type, but they are re-used below to
+        # map global indices to regional indices, so widen them first
+        bdyMaskCell = bdyMaskCell.astype(np.int32)
+        bdyMaskEdge = bdyMaskEdge.astype(np.int32)
+        bdyMaskVertex = bdyMaskVertex.astype(np.int32)
+
         indexingFields = {}
         indexingFields['indexToCellID'] = bdyMaskCell
         indexingFields['indexToEdgeID'] = bdyMaskEdge
@@ -388,6 +436,21 @@ def latlon_to_xyz(lat, lon, radius):
     return np.array([x, y, z])
 
 
+def latlon_to_xyz_vec(lat, lon, radius=1.0):
+    """ Vectorized version of latlon_to_xyz. Return an array of shape
+    lat.shape + (3,) of the x, y, z coordinates of lat, lon on the sphere
+    that has radius, radius.
+
+    lat - Array of latitudes
+    lon - Array of longitudes
+    radius - Radius of sphere
+    """
+    cosLat = np.cos(lat)
+    return np.stack([radius * cosLat * np.cos(lon),
+                     radius * cosLat * np.sin(lon),
+                     radius * np.sin(lat)], axis=-1)
+
+
 def xyz_to_latlon(point):
     """ Convert a Cartesian coordinate point into a latitude,
         longitude point in radians """